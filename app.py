@@ -1,7 +1,5 @@
 import streamlit as st
-import pandas as pd
 import numpy as np
-import pickle
 import os
 import matplotlib.pyplot as plt
 import matplotlib.patches as mpatches
@@ -642,13 +640,16 @@ h1, h2, h3, h4, h5, h6 {
 
 
 # ─── DATA LOADING ──────────────────────────────────────────────────────────────
-@st.cache_resource
 def load_model():
-    for path in ["dt_model.pkl", "model/dt_model.pkl"]:
-        if os.path.exists(path):
-            with open(path, "rb") as f:
-                return pickle.load(f)
-    return None
+    # Same cached package the agent tools score with (agent_pipeline keeps it
+    # for the life of the process, across Streamlit reruns)
+    if not os.path.exists(agent_pipeline.MODEL_PATH) and os.path.exists("model/dt_model.pkl"):
+        # The app used to find the model under model/ as well
+        os.environ["DT_MODEL_PATH"] = agent_pipeline.MODEL_PATH = "model/dt_model.pkl"
+    try:
+        return agent_pipeline.load_model_package()
+    except (FileNotFoundError, TypeError, KeyError):
+        return None
 
 pkg = load_model()
 
@@ -659,18 +660,14 @@ if pkg is None:
         <div style="font-family:'Playfair Display',Georgia,serif;font-size:1.8rem;
                     color:#000000;font-weight:700;">Model Not Found</div>
         <div style="color:#222222;font-size:0.95rem;">
-            Place dt_model.pkl in the same directory as app.py</div>
+            Place dt_model.pkl (or model/dt_model.pkl) next to app.py, or set DT_MODEL_PATH</div>
     </div>
     """, unsafe_allow_html=True)
     st.stop()
 
-model          = pkg["model"]
-lr_model       = pkg["lr_model"]
-scaler         = pkg["scaler"]
-encoders       = pkg.get("encoders", {})
 feature_cols   = pkg["feature_columns"]
-dt_threshold   = pkg.get("dt_threshold", 0.35)
-lr_threshold   = pkg.get("lr_threshold", 0.35)
+dt_threshold   = agent_pipeline.model_threshold(pkg, "dt")
+lr_threshold   = agent_pipeline.model_threshold(pkg, "lr")
 dinfo          = pkg["dataset_info"]
 dtm            = pkg["dt_metrics"]
 lrm            = pkg.get("lr_metrics", {})
@@ -1125,61 +1122,103 @@ elif page == "Predict":
             if not os.environ.get("GROQ_API_KEY"):
                 st.error("Groq API Key not found. Please add it to Streamlit Secrets (e.g., in .streamlit/secrets.toml) or set the GROQ_API_KEY environment variable.")
             else:
-                with st.spinner("Agent Planner is formulating strategy..."):
-                    applicant_features = {
-                        "age": person_age,
-                        "income": person_income,
-                        "employment_years": person_emp_length,
-                        "home_ownership": person_home_ownership,
-                        "loan_intent": loan_intent,
-                        "loan_amount": loan_amnt,
-                        "interest_rate": loan_int_rate,
-                        "default_on_file": cb_default,
-                        "credit_history": cred_hist
+                applicant_features = {
+                    "age": person_age,
+                    "income": person_income,
+                    "employment_years": person_emp_length,
+                    "home_ownership": person_home_ownership,
+                    "loan_intent": loan_intent,
+                    "loan_amount": loan_amnt,
+                    "interest_rate": loan_int_rate,
+                    "default_on_file": cb_default,
+                    "credit_history": cred_hist
+                }
+                try:
+                    # Render each phase as its events arrive instead of waiting
+                    # for the whole run: plan, tool results, audit, then the
+                    # report token by token.
+                    st.subheader("Agent Analysis Results")
+                    status       = st.status("Agent Planner is formulating strategy...", expanded=False)
+                    verdict_slot = st.empty()
+                    plan_box     = st.expander("1. Step-By-Step Plan", expanded=True)
+                    tools_box    = st.expander("2. Tool Executions & Risk Flags")
+                    reflect_box  = st.expander("3. Reflector Audit")
+                    st.markdown("### Final Narrative Report")
+                    report_slot  = st.empty()
+
+                    phase_labels = {
+                        "router":    "Checking for a clear-cut decision...",
+                        "planner":   "Agent Planner is formulating strategy...",
+                        "executor":  "Executor is running tools...",
+                        "reflector": "Reflector is auditing the analysis...",
+                        "reporter":  "Reporter is writing the narrative...",
                     }
-                    try:
-                        state = agent_pipeline.run_per_agent(applicant_features, verbose=False)
-                        st.subheader("Agent Analysis Results")
-
-                        if state.get("final_decision"):
-                            if state["final_decision"] == "APPROVE":
-                                st.success("FINAL VERDICT: APPROVE")
-                            else:
-                                st.error("FINAL VERDICT: REJECT")
-
-                        with st.expander("1. Step-By-Step Plan", expanded=True):
-                            plan_items = state.get("plan", [])
-                            if plan_items:
-                                for idx, p in enumerate(plan_items, 1):
-                                    st.markdown(f"**Step {idx}:** {p.get('action')} - {p.get('reason')}")
-                            else:
-                                st.write("No plan generated.")
-                        
-                        with st.expander("2. Tool Executions & Risk Flags"):
-                            logs = state.get("execution_log", [])
-                            for log in logs:
-                                st.markdown(f"**Executed Tool:** `{log.get('tool')}`")
-                                result = log.get('result', {})
+                    report_text, state = "", {}
+                    for event in agent_pipeline.stream_per_agent(applicant_features):
+                        kind = event["type"]
+                        if kind == "phase_start":
+                            status.update(label=phase_labels.get(event["phase"], event["phase"]))
+                        elif kind == "route" and event.get("tier") != "agent":
+                            with plan_box:
+                                st.markdown(f"**Fast path ({event.get('tier')}):** {event.get('reason')}. "
+                                            "The agent was not needed for this applicant.")
+                        elif kind == "plan":
+                            with plan_box:
+                                plan_items = event.get("plan") or []
+                                if plan_items:
+                                    for idx, p in enumerate(plan_items, 1):
+                                        st.markdown(f"**Step {idx}:** {p.get('action')} - {p.get('reason')}")
+                                else:
+                                    st.write("No plan generated.")
+                        elif kind == "tool_result":
+                            with tools_box:
+                                st.markdown(f"**Executed Tool:** `{event.get('tool')}`")
+                                result = event.get("result", {})
                                 if isinstance(result, dict) or isinstance(result, list):
                                     st.json(result)
                                 else:
                                     st.info(str(result))
-                        
-                        
-                        with st.expander("3. Reflector Audit"):
-                            reflection = state.get("reflection", {})
-                            st.json(reflection)
-                            
-                        st.markdown("### Final Narrative Report")
-                        st.markdown(state.get("final_report", "No report available."))
-                        
-                    except Exception as e:
-                        st.error(f"Agent Execution Failed: {e}")
+                        elif kind == "decision":
+                            if event.get("decision") == "APPROVE":
+                                verdict_slot.success("FINAL VERDICT: APPROVE")
+                            elif event.get("decision"):
+                                verdict_slot.error("FINAL VERDICT: REJECT")
+                        elif kind == "reflection":
+                            with reflect_box:
+                                st.json(event.get("reflection") or {})
+                        elif kind == "report_draft":
+                            report_slot.markdown(event.get("report") or "")
+                        elif kind == "token":
+                            report_text += event["text"]
+                            report_slot.markdown(report_text + "▌")
+                        elif kind == "stream_reset":
+                            report_text = ""
+                            report_slot.empty()
+                        elif kind == "report":
+                            report_slot.markdown(event.get("report") or "No report available.")
+                        elif kind == "error":
+                            st.error(f"Agent Execution Failed: {event.get('error')}")
+                        elif kind == "done":
+                            state = event["state"]
+
+                    if state.get("final_decision") == "APPROVE":
+                        verdict_slot.success("FINAL VERDICT: APPROVE")
+                    elif state.get("final_decision"):
+                        verdict_slot.error("FINAL VERDICT: REJECT")
+                    if not state.get("final_report"):
+                        report_slot.markdown("No report available.")
+                    status.update(
+                        label="Agent analysis complete" if state.get("final_decision") else "Agent analysis finished with errors",
+                        state="complete" if state.get("final_decision") else "error",
+                    )
+
+                except Exception as e:
+                    st.error(f"Agent Execution Failed: {e}")
 
         elif submitted_ml:
             with st.spinner("Analyzing risk profile..."):
                 # 1. Select model and threshold
-                active_model     = model        if selected_model_name == "Decision Tree" else lr_model
+                active_model     = "dt"         if selected_model_name == "Decision Tree" else "lr"
                 active_threshold = dt_threshold if selected_model_name == "Decision Tree" else lr_threshold
 
                 # 2. Compute loan_percent_income
@@ -1199,20 +1238,10 @@ elif page == "Predict":
                     "cb_person_cred_hist_length":   cred_hist,
                 }
 
-                # 4. Fallback missing categorical columns manually for pd.get_dummies if needed (matches notebook setup)
-                cat_cols = ["person_home_ownership", "loan_intent", "cb_person_default_on_file"]
-                df_input = pd.DataFrame([row])
-                df_enc   = pd.get_dummies(df_input, columns=cat_cols, drop_first=True)
-
-                # 5. Align to training feature columns (fill 0 for missing features)
-                df_aligned = df_enc.reindex(columns=feature_cols, fill_value=0)
-
                 try:
-                    # 6. Scale and Predict
-                    X_scaled = scaler.transform(df_aligned.values)
-                    proba        = active_model.predict_proba(X_scaled)[0]
-                    default_prob = float(proba[1])
-                    pred         = 1 if default_prob >= active_threshold else 0
+                    # 4. Encode, scale and predict through the shared inference core
+                    default_prob = agent_pipeline.predict_default_proba(row, model=active_model)
+                    pred         = agent_pipeline.predict_with_threshold(pkg, default_prob, active_model)
                     conf         = max(default_prob, 1 - default_prob) * 100
 
                     if default_prob < 0.30:   risk, risk_cls = "LOW RISK",    "risk-low"
@@ -0,0 +1,445 @@
+"""
+Score a CSV of applicants end to end, streaming it in fixed-size chunks.
+
+    python batch_runner.py data/cleaned/cleaned_credit_risk.csv --mode flags --out results.parquet
+
+Modes
+-----
+ml       preprocess_and_predict_batch()   -- one vectorised model call per chunk
+flags    compute_risk_flags_batch()       -- compiled rulebook masks per chunk
+segment  score_applicant_segment_batch()  -- one searchsorted per metric per chunk
+agent    CreditIQEngine.arun()            -- full Plan-Execute-Reflect pipeline,
+                                             at most --concurrency runs in flight;
+                                             --llm-batch packs their Planner and
+                                             Reporter calls into shared requests
+
+Only one chunk of input and output is held at a time, and latencies go into a
+fixed-size log histogram, so memory stays flat however large the file is.
+
+Output is a single CSV appended chunk by chunk, or (for a .parquet path) a
+directory of part-NNNNN.parquet files that pandas.read_parquet() reads as one
+table. After every chunk a <out>.checkpoint.json sidecar records how far the run
+got; --resume continues from there instead of starting over.
+"""
+import argparse
+import asyncio
+import json
+import math
+import os
+import shutil
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+
+from agent_pipeline import (
+    LLM_POOL_SIZE,
+    _ALIAS_MAP,
+    _DEFAULTS,
+    CreditIQEngine,
+    compute_risk_flags_batch,
+    llm_batch_stats,
+    make_llm_batchers,
+    preprocess_and_predict_batch,
+    score_applicant_segment_batch,
+)
+
+DATASET_PATH = "data/cleaned/cleaned_credit_risk.csv"
+
+MODES = ("ml", "flags", "segment", "agent")
+
+# Rows per chunk. Agent chunks are small so a checkpoint lands every few seconds.
+DEFAULT_CHUNKSIZE       = 10_000
+DEFAULT_AGENT_CHUNKSIZE = 64
+
+# Latency histogram: log-spaced buckets, ~1% wide, from 1 us to ~1000 s
+_HIST_MIN_S   = 1e-6
+_HIST_GROWTH  = 1.01
+_HIST_BUCKETS = int(math.log(1e9) / math.log(_HIST_GROWTH)) + 1
+
+# Columns the pipeline reads; everything else (e.g. the loan_status label)
+# is kept away from the agent so it never reaches an LLM prompt.
+_FEATURE_COLUMNS = set(_DEFAULTS) | set(_ALIAS_MAP)
+
+
+# =============================================================================
+# LATENCY HISTOGRAM
+# =============================================================================
+
+def make_latency_histogram():
+    """Empty constant-size latency histogram (see histogram_record)."""
+    return {"counts": np.zeros(_HIST_BUCKETS, dtype=np.int64), "n": 0}
+
+
+def histogram_record(hist, seconds, count=1):
+    """
+    Record `count` observations of `seconds` each.
+
+    Agent mode records one observation per row. Vectorised modes score a
+    chunk in one call and have no per-row timing, so they record the chunk's
+    amortised per-row latency once per chunk (see run_batch's latency_basis).
+    """
+    seconds = max(float(seconds), _HIST_MIN_S)
+    idx = min(int(math.log(seconds / _HIST_MIN_S) / math.log(_HIST_GROWTH)), _HIST_BUCKETS - 1)
+    hist["counts"][idx] += count
+    hist["n"] += count
+
+
+def histogram_percentile(hist, q):
+    """Latency in seconds at percentile q (0-100), accurate to one bucket (~1%)."""
+    if hist["n"] == 0:
+        return float("nan")
+    rank = max(int(math.ceil(hist["n"] * q / 100.0)), 1)
+    idx  = int(np.searchsorted(np.cumsum(hist["counts"]), rank))
+    return _HIST_MIN_S * _HIST_GROWTH ** (idx + 0.5)
+
+
+# =============================================================================
+# CHUNK SCORERS -- DataFrame chunk in, result DataFrame out (same row order)
+# =============================================================================
+
+def _raise_on_error(result, mode):
+    if isinstance(result, dict) and "error" in result:
+        raise RuntimeError(f"{mode} scoring failed: {result['error']}")
+
+
+def score_chunk_ml(chunk):
+    results = preprocess_and_predict_batch(chunk)
+    if results and "error" in results[0]:
+        raise RuntimeError(f"ml scoring failed: {results[0]['error']}")
+    out = pd.DataFrame(results, index=chunk.index)
+    return out[["prediction", "probability", "confidence_band", "decision"]]
+
+
+def score_chunk_flags(chunk):
+    result = compute_risk_flags_batch(chunk)
+    _raise_on_error(result, "flags")
+
+    # Few distinct bitmasks per chunk: name each one once
+    names  = result["flag_names"]
+    joined = {
+        m: "|".join(name for j, name in enumerate(names) if m >> j & 1)
+        for m in set(result["bitmask"].tolist())
+    }
+    return pd.DataFrame({
+        "flags":          [joined[m] for m in result["bitmask"].tolist()],
+        "flag_count":     result["flag_count"],
+        "severity_score": result["severity_score"],
+        "severity":       result["severity"],
+        "flag_bitmask":   result["bitmask"],
+    }, index=chunk.index)
+
+
+def score_chunk_segment(chunk, percentile_mode=None):
+    result = score_applicant_segment_batch(chunk, mode=percentile_mode)
+    _raise_on_error(result, "segment")
+
+    out = pd.DataFrame(result["percentiles"], index=chunk.index)
+    out["composite_risk_score"] = result["composite_risk_score"]
+    out["segment"]              = result["segment"]
+    return out
+
+
+def _agent_row(state, elapsed):
+    ml       = state.get("ml_output") or {}
+    flags    = state.get("risk_flags") or {}
+    segment  = state.get("segment_score") or {}
+    errors   = state.get("error_log") or []
+    return {
+        "final_decision":  state.get("final_decision"),
+        "probability":     ml.get("probability"),
+        "severity":        flags.get("severity"),
+        "segment":         segment.get("segment"),
+        "reflect_retries": state.get("reflect_retries", 0),
+        "error_count":     len(errors),
+        "first_error":     errors[0]["error"] if errors else None,
+        "final_report":    state.get("final_report"),
+        "latency_ms":      round(elapsed * 1000.0, 1),
+    }
+
+
+async def score_chunk_agent(chunk, engine, concurrency, llm_batchers=None):
+    """
+    Run the agent pipeline for every row of a chunk, at most `concurrency` at once.
+
+    Returns the result frame and the per-row wall-clock latencies in seconds.
+    A run that raises still fills its row, with the error in first_error.
+    llm_batchers (make_llm_batchers()) lets the runs share batched LLM calls.
+    """
+    features = [c for c in chunk.columns if c in _FEATURE_COLUMNS]
+    records  = (
+        chunk[features].astype(object)
+        .where(chunk[features].notna(), None)
+        .to_dict("records")
+    )
+    slots = asyncio.Semaphore(concurrency)
+
+    async def run_one(applicant_data):
+        async with slots:
+            t0 = time.perf_counter()
+            try:
+                state = await engine.arun(applicant_data, verbose=False, priority="batch",
+                                          llm_batchers=llm_batchers)
+            except Exception as exc:
+                state = engine._failed_state(applicant_data, exc, False)
+            return state, time.perf_counter() - t0
+
+    outcomes = await asyncio.gather(*(run_one(r) for r in records))
+    out = pd.DataFrame([_agent_row(s, dt) for s, dt in outcomes], index=chunk.index)
+    return out, [dt for _, dt in outcomes]
+
+
+# =============================================================================
+# OUTPUT + CHECKPOINT
+# =============================================================================
+
+def checkpoint_path(out_path):
+    return out_path + ".checkpoint.json"
+
+
+def _input_fingerprint(input_path):
+    st = os.stat(input_path)
+    return {"path": os.path.abspath(input_path), "size": st.st_size, "mtime_ns": st.st_mtime_ns}
+
+
+def load_checkpoint(out_path, input_path, mode):
+    """
+    Return the saved checkpoint for this run, or None when starting fresh.
+
+    Raises ValueError if the checkpoint belongs to a different input file or
+    mode, since resuming would silently mix incompatible outputs.
+    """
+    path = checkpoint_path(out_path)
+    if not os.path.exists(path):
+        return None
+    with open(path, "r", encoding="utf-8") as f:
+        ckpt = json.load(f)
+    if ckpt.get("input") != _input_fingerprint(input_path) or ckpt.get("mode") != mode:
+        raise ValueError(
+            f"{path} was written for mode={ckpt.get('mode')!r} on "
+            f"{ckpt.get('input', {}).get('path')!r}; remove it or drop --resume"
+        )
+    return ckpt
+
+
+def save_checkpoint(out_path, ckpt):
+    """Write the checkpoint atomically so a crash never leaves a torn file."""
+    path = checkpoint_path(out_path)
+    tmp  = path + ".tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(ckpt, f, indent=2)
+    os.replace(tmp, path)
+
+
+def open_writer(out_path, ckpt):
+    """
+    Open the output for chunk-by-chunk writing, positioned after the checkpoint.
+
+    Returns
+    -------
+    dict with keys:
+        write(frame) -> dict  -- append one chunk; returns the position fields
+                                 ("parts" or "out_bytes") to store in the checkpoint
+        close()
+    """
+    if out_path.endswith(".parquet"):
+        try:
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+        except ImportError:
+            raise SystemExit("Writing .parquet needs pyarrow (pip install pyarrow), "
+                             "or pass an --out path ending in .csv")
+
+        if ckpt is None and os.path.exists(out_path):
+            shutil.rmtree(out_path) if os.path.isdir(out_path) else os.remove(out_path)
+        os.makedirs(out_path, exist_ok=True)
+        state = {"parts": ckpt["parts"] if ckpt else 0}
+
+        def write(frame):
+            # Parts past the checkpoint are leftovers of a crash and get overwritten
+            part = os.path.join(out_path, f"part-{state['parts']:05d}.parquet")
+            pq.write_table(pa.Table.from_pandas(frame, preserve_index=False), part)
+            state["parts"] += 1
+            return {"parts": state["parts"]}
+
+        return {"write": write, "close": lambda: None}
+
+    # CSV: truncate to the checkpointed offset to drop a half-written chunk
+    f = open(out_path, "r+b" if ckpt else "wb")
+    if ckpt:
+        f.truncate(ckpt["out_bytes"])
+        f.seek(ckpt["out_bytes"])
+
+    def write(frame):
+        frame.to_csv(f, header=f.tell() == 0, index=False)
+        f.flush()
+        return {"out_bytes": f.tell()}
+
+    return {"write": write, "close": f.close}
+
+
+# =============================================================================
+# DRIVER
+# =============================================================================
+
+def run_batch(input_path, mode, out_path, chunksize=None, concurrency=LLM_POOL_SIZE,
+              resume=False, keep_input=False, percentile_mode=None, verbose=True,
+              llm_batch=False):
+    """
+    Score every row of `input_path` in `mode` and write the results to `out_path`.
+
+    Parameters
+    ----------
+    input_path  : str        CSV with friendly or internal column names.
+    mode        : str        One of MODES.
+    out_path    : str        .csv file or .parquet dataset directory.
+    chunksize   : int/None   Rows per chunk. None picks a per-mode default.
+    concurrency : int        Agent runs in flight (agent mode only).
+    resume      : bool       Continue from <out_path>.checkpoint.json if present.
+    keep_input  : bool       Copy the input columns into the output.
+    percentile_mode : str/None  "bucketed" or "dense" (segment mode only).
+    verbose     : bool       Print one progress line per chunk to stderr.
+    llm_batch   : bool       Batch the Planner and Reporter calls of concurrent
+                             runs (agent mode only).
+
+    Returns
+    -------
+    dict with keys:
+        rows, rows_skipped, elapsed_s, rows_per_s,
+        latency_ms -- {"p50": float, "p95": float, "p99": float}
+        latency_basis -- "per_row": percentiles of each row's latency (agent
+                         mode); "chunk_amortised": percentiles over chunks of
+                         chunk time / rows, which hide per-row tails
+        llm_batch  -- llm_batch_stats() (with llm_batch=True only)
+    """
+    if mode not in MODES:
+        raise ValueError(f"mode must be one of {MODES}, got {mode!r}")
+    if chunksize is None:
+        chunksize = DEFAULT_AGENT_CHUNKSIZE if mode == "agent" else DEFAULT_CHUNKSIZE
+
+    ckpt = load_checkpoint(out_path, input_path, mode) if resume else None
+    if ckpt is None and os.path.exists(checkpoint_path(out_path)):
+        os.remove(checkpoint_path(out_path))
+    skip = ckpt["rows_done"] if ckpt else 0
+
+    writer = open_writer(out_path, ckpt)
+    hist   = make_latency_histogram()
+    rows_done = skip
+    position  = {k: ckpt[k] for k in ("parts", "out_bytes") if ckpt and k in ckpt}
+
+    engine, loop, batchers = None, None, None
+    if mode == "agent":
+        engine = CreditIQEngine(max_workers=concurrency)
+        loop   = asyncio.new_event_loop()
+        if llm_batch:
+            batchers = make_llm_batchers(concurrency)
+
+    reader = pd.read_csv(
+        input_path,
+        chunksize=chunksize,
+        skiprows=range(1, skip + 1) if skip else None,
+    )
+    t_start = time.perf_counter()
+    try:
+        for chunk in reader:
+            chunk.index = pd.RangeIndex(rows_done, rows_done + len(chunk))
+
+            t0 = time.perf_counter()
+            if mode == "agent":
+                result, latencies = loop.run_until_complete(
+                    score_chunk_agent(chunk, engine, concurrency, batchers)
+                )
+                for dt in latencies:
+                    histogram_record(hist, dt)
+            else:
+                if mode == "ml":
+                    result = score_chunk_ml(chunk)
+                elif mode == "flags":
+                    result = score_chunk_flags(chunk)
+                else:
+                    result = score_chunk_segment(chunk, percentile_mode)
+                histogram_record(hist, (time.perf_counter() - t0) / len(chunk))
+
+            frame = pd.concat([chunk, result], axis=1) if keep_input else result
+            frame.insert(0, "row_id", chunk.index)
+
+            position.update(writer["write"](frame))
+            rows_done += len(chunk)
+            save_checkpoint(out_path, {
+                "input": _input_fingerprint(input_path), "mode": mode,
+                "rows_done": rows_done, **position,
+            })
+
+            if verbose:
+                done = rows_done - skip
+                rate = done / max(time.perf_counter() - t_start, 1e-9)
+                print(f"  {mode}: {rows_done:,} rows ({rate:,.0f} rows/s)", file=sys.stderr)
+    finally:
+        writer["close"]()
+        if engine is not None:
+            loop.run_until_complete(engine.aclose())
+            loop.close()
+
+    elapsed = time.perf_counter() - t_start
+    rows    = rows_done - skip
+    stats   = {
+        "rows":         rows,
+        "rows_skipped": skip,
+        "elapsed_s":    elapsed,
+        "rows_per_s":   rows / elapsed if elapsed > 0 else float("nan"),
+        "latency_ms":   {
+            f"p{q}": histogram_percentile(hist, q) * 1000.0 for q in (50, 95, 99)
+        },
+        "latency_basis": "per_row" if mode == "agent" else "chunk_amortised",
+    }
+    if batchers is not None:
+        stats["llm_batch"] = llm_batch_stats()
+    return stats
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Score a CSV of applicants in streamed chunks."
+    )
+    parser.add_argument("input", nargs="?", default=DATASET_PATH, help="applicant CSV")
+    parser.add_argument("--mode", choices=MODES, required=True)
+    parser.add_argument("--out", required=True, help="output .csv file or .parquet directory")
+    parser.add_argument("--chunksize", type=int, default=None,
+                        help=f"rows per chunk (default {DEFAULT_CHUNKSIZE:,}; "
+                             f"{DEFAULT_AGENT_CHUNKSIZE} in agent mode)")
+    parser.add_argument("--concurrency", type=int, default=LLM_POOL_SIZE,
+                        help="agent runs in flight (agent mode)")
+    parser.add_argument("--resume", action="store_true",
+                        help="continue from the checkpoint next to --out")
+    parser.add_argument("--keep-input", action="store_true",
+                        help="copy the input columns into the output")
+    parser.add_argument("--percentile-mode", choices=("bucketed", "dense"), default=None,
+                        help="peer table used in segment mode")
+    parser.add_argument("--llm-batch", action="store_true",
+                        help="pack concurrent runs' Planner and Reporter calls together (agent mode)")
+    args = parser.parse_args()
+
+    stats = run_batch(
+        args.input, args.mode, args.out,
+        chunksize=args.chunksize, concurrency=args.concurrency, resume=args.resume,
+        keep_input=args.keep_input, percentile_mode=args.percentile_mode,
+        llm_batch=args.llm_batch,
+    )
+    lat = stats["latency_ms"]
+    skipped = f" ({stats['rows_skipped']:,} resumed from checkpoint)" if stats["rows_skipped"] else ""
+    print(f"Scored {stats['rows']:,} rows{skipped} in {stats['elapsed_s']:.2f}s "
+          f"-> {args.out}")
+    print(f"  throughput : {stats['rows_per_s']:,.0f} rows/s")
+    basis = ("per-row latency" if stats["latency_basis"] == "per_row"
+             else "chunk-amortised latency per row, over chunks")
+    print(f"  {basis} (ms): p50 {lat['p50']:.4f}  p95 {lat['p95']:.4f}  "
+          f"p99 {lat['p99']:.4f}")
+    for phase, row in stats.get("llm_batch", {}).items():
+        print(f"  {phase} batching: {row['requests']} requests for {row['applicants']} runs "
+              f"({row['requeued']} re-queued), {row['saved_tokens_per_applicant']} prompt "
+              f"tokens saved per applicant")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,23 @@
+import argparse
+
+from agent_pipeline import PEER_QUANTILES_PATH, build_peer_quantile_tables
+
+DATASET_PATH = "data/cleaned/cleaned_credit_risk.csv"
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Build the dense peer quantile tables used by score_applicant_segment."
+    )
+    parser.add_argument("--csv", default=DATASET_PATH, help="training dataset to rank against")
+    parser.add_argument("--out", default=PEER_QUANTILES_PATH, help="destination .npz artifact")
+    parser.add_argument("--quantiles", type=int, default=1000, help="quantiles per metric")
+    args = parser.parse_args()
+
+    arrays = build_peer_quantile_tables(args.csv, args.out, args.quantiles)
+    print(f"Wrote {args.quantiles} quantiles per metric from {int(arrays['n_rows'])} rows "
+          f"to {args.out} (source sha256 {str(arrays['source_sha256'])[:12]}...)")
+
+
+if __name__ == "__main__":
+    main()